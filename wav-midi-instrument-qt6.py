@@ -1,26 +1,188 @@
 import sys
 import os
+import hashlib
+import mmap
+import tempfile
+from collections import OrderedDict
+from fractions import Fraction
 from PyQt6 import QtWidgets, QtCore, QtGui
 import pygame.mixer
+import pygame.sndarray
 import rtmidi
 import numpy as np
 from scipy.io import wavfile
 from scipy import signal
 
+try:
+    import soxr
+except ImportError:
+    soxr = None
+
+# soxr quality preset: 'QQ' is several times faster but audibly rougher, 'HQ' is still well ahead of scipy
+SOXR_QUALITY = 'HQ'
+
+# Designed filters per (up, down); pitch ratios come from a fixed table, so this stays small for the whole session
+FIR_CACHE = {}
+
+def design_resample_filter(up, down):
+    # Same Kaiser low-pass resample_poly would design, built explicitly so it can be reused
+    taps = FIR_CACHE.get((up, down))
+    if taps is None:
+        max_rate = max(up, down)
+        # float32 taps keep resample_poly in float32 instead of promoting the output to float64
+        taps = signal.firwin(2 * 10 * max_rate + 1, 1.0 / max_rate, window=('kaiser', 8.0)).astype(np.float32)
+        FIR_CACHE[(up, down)] = taps
+    return taps
+
+def resample_poly_ratio(data, up, down):
+    # Polyphase resampling: cost scales with the filter length, not the prime factors of the length
+    if up == down:
+        return data.copy()
+    if soxr is not None:
+        return soxr.resample(data, down, up, quality=SOXR_QUALITY)
+    return signal.resample_poly(data, up, down, window=design_resample_filter(up, down))
+
+def downmix(audio_data):
+    # 8/16-bit stereo is averaged in int32, which is exact and avoids np.mean's float64 upcast
+    if audio_data.shape[1] == 2 and audio_data.dtype.kind in 'iu' and audio_data.dtype.itemsize <= 2:
+        return ((audio_data[:, 0].astype(np.int32) + audio_data[:, 1]) >> 1).astype(audio_data.dtype)
+    return np.mean(audio_data, axis=1, dtype=np.float32)
+
+def peak_abs(audio_data):
+    # max/min reduce in place, unlike np.abs(...).max() which first materialises |x|
+    return max(float(audio_data.max()), -float(audio_data.min()))
+
+# 12-TET pitch ratios for every semitone offset -127..127, as rationals usable by resample_poly.
+# Downward offsets are the reciprocals of the upward ones; limit_denominator would round them all to about 1/1000
+UP_RATIOS = [Fraction(2 ** (k / 12)).limit_denominator(1000) for k in range(128)]
+SEMI_RATIOS = [1 / frac for frac in reversed(UP_RATIOS[1:])] + UP_RATIOS
+
+def resample_factors(target_note, source_note):
+    # Playing higher means fewer samples: upsample by the denominator, downsample by the numerator
+    frac = SEMI_RATIOS[target_note - source_note + 127]
+    return frac.denominator, frac.numerator
+
+# G.711 mu-law: 8 bits per sample in the stored bank, expanded back to int16 when a note is played
+ULAW_BIAS = 0x84
+ULAW_SEGMENTS = np.array([i.bit_length() for i in range(128)], dtype=np.int32)
+
+def ulaw_decode_table():
+    codes = ~np.arange(256, dtype=np.int32)
+    exponent = (codes >> 4) & 0x07
+    magnitude = ((((codes & 0x0F) << 3) + ULAW_BIAS) << exponent) - ULAW_BIAS
+    return np.where(codes & 0x80, -magnitude, magnitude).astype(np.int16)
+
+ULAW_DECODE = ulaw_decode_table()
+
+def ulaw_encode(pcm, out=None):
+    # 14-bit segment search of the CCITT reference coder, so codes match audioop.lin2ulaw
+    if out is None:
+        out = np.empty(len(pcm), dtype=np.uint8)
+    pcm = pcm.astype(np.int32) >> 2
+    mask = np.where(pcm < 0, 0x7F, 0xFF)
+    magnitude = np.minimum(np.abs(pcm) + (ULAW_BIAS >> 2), 0x1FFF)
+    segment = ULAW_SEGMENTS[magnitude >> 6]
+    mantissa = (magnitude >> (segment + 1)) & 0x0F
+    return np.bitwise_xor((segment << 4) | mantissa, mask, out=out, casting='unsafe')
+
+def allocate_bank(rows, length):
+    # File-backed rows: the OS can drop pages of notes that are not playing instead of holding them in RAM
+    size = max(rows * length, 1)
+    with tempfile.TemporaryFile() as f:
+        f.truncate(size)
+        bank_map = mmap.mmap(f.fileno(), size)
+    if hasattr(bank_map, 'madvise'):
+        bank_map.madvise(mmap.MADV_SEQUENTIAL)
+    return np.ndarray((rows, length), dtype=np.uint8, buffer=bank_map)
+
+# Processed banks kept in the temp directory; older ones are deleted as new ones are written
+BANK_CACHE_LIMIT = 8
+
+def resampler_backend():
+    if soxr is not None:
+        return f'soxr{SOXR_QUALITY}'
+    return 'scipy'
+
+def bank_cache_path(sample_hash, min_note, max_note, base_note):
+    # Processed banks are cached per sample content, note layout and resampler, so reprocessing is a single file read
+    return os.path.join(tempfile.gettempdir(),
+                        f"wmi-{sample_hash}-{min_note}-{max_note}-{base_note}-{resampler_backend()}.npz")
+
+def prune_bank_cache():
+    banks = []
+    with os.scandir(tempfile.gettempdir()) as entries:
+        for entry in entries:
+            if entry.name.startswith('wmi-') and entry.name.endswith('.npz'):
+                try:
+                    banks.append((entry.stat().st_mtime, entry.path))
+                except OSError:
+                    pass
+    banks.sort(reverse=True)
+    for _, path in banks[BANK_CACHE_LIMIT:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+# Decoded Sounds kept around for recently played notes
+SOUND_POOL_SIZE = 16
+
+class ResampleSignals(QtCore.QObject):
+    done = QtCore.pyqtSignal(int, object)
+
+class ResampleTask(QtCore.QRunnable):
+    def __init__(self, data, up, down, note, signals):
+        super().__init__()
+        self.data = data
+        self.up = up
+        self.down = down
+        self.note = note
+        self.signals = signals
+
+    def run(self):
+        # Runs on a pool thread; the result is queued back to the GUI thread through the signal
+        try:
+            resampled = resample_poly_ratio(self.data, self.up, self.down)
+        except Exception as e:
+            resampled = e
+        self.signals.done.emit(self.note, resampled)
+
 class WavInstrumentApp(QtWidgets.QMainWindow):
     def __init__(self):
         super().__init__()
         self.setWindowTitle("WAV MIDI Instrument")
         self.setGeometry(100, 100, 800, 600)
 
-        # Initialize audio with specific settings
-        pygame.mixer.pre_init(44100, -16, 2, 512)
-        pygame.mixer.init()
-        pygame.mixer.set_num_channels(128)
+        self.master_volume = 0.8
+        # Handler per MIDI status byte: Note Off (0x80-0x8F) and Note On (0x90-0x9F) on every channel
+        self.midi_dispatch = [None] * 256
+        self.midi_dispatch[0x80:0x90] = [self.note_off] * 16
+        self.midi_dispatch[0x90:0xA0] = [self.note_on] * 16
         
         self.base_sample = None
-        self.processed_sounds = {}
-        self.active_notes = {}
+        # Per-note state is indexed by MIDI note number (0-127), with None for notes that have nothing;
+        # active_notes holds the (channel, sound) each sounding note was started with
+        self.processed_sounds = [None] * 128
+        self.sound_pool = OrderedDict()
+        self.active_notes = [None] * 128
+        self.resample_cache = {}
+        self.cache_layout = None
+        self.pending_notes = {}
+        self.bank_cache_path = None
+        self.pcm_scratch = np.empty(0, dtype=np.int16)
+        self.clip_scratch = np.empty(0, dtype=np.float32)
+        self.bank = None
+        self.bank_rows = {}
+        self.resample_signals = ResampleSignals()
+        self.resample_signals.done.connect(self.note_resampled)
+        # MIDI callbacks run on rtmidi's thread, so they only store the latest event text;
+        # the GUI thread repaints it at most 20 times a second
+        self.debug_enabled = True
+        self.pending_debug = None
+        self.shown_debug = None
+
+        # Initialize audio with specific settings
+        self.init_mixer(44100)
         
         # GUI Setup
         central_widget = QtWidgets.QWidget()
@@ -42,6 +204,15 @@ class WavInstrumentApp(QtWidgets.QMainWindow):
         
         self.note_debug = QtWidgets.QLabel("Last MIDI event: None")
         debug_layout.addWidget(self.note_debug)
+
+        self.debug_checkbox = QtWidgets.QCheckBox("Show MIDI events")
+        self.debug_checkbox.setChecked(self.debug_enabled)
+        self.debug_checkbox.toggled.connect(self.set_debug_enabled)
+        debug_layout.addWidget(self.debug_checkbox)
+
+        self.debug_timer = QtCore.QTimer(self)
+        self.debug_timer.timeout.connect(self.flush_debug)
+        self.debug_timer.start(50)
         
         debug_group.setLayout(debug_layout)
         layout.addWidget(debug_group)
@@ -124,11 +295,45 @@ class WavInstrumentApp(QtWidgets.QMainWindow):
         self.get_available_midi_ports()
         self.midi_port_selector.currentIndexChanged.connect(self.select_midi_input)
 
+    def init_mixer(self, rate):
+        # Mono 16-bit at the sample's own rate, so note buffers are handed to SDL without conversion
+        if pygame.mixer.get_init() == (rate, -16, 1):
+            return
+        pygame.mixer.quit()
+        pygame.mixer.init(rate, -16, 1, 512, allowedchanges=0)
+        pygame.mixer.set_num_channels(128)
+        # Notes take the next channel round-robin instead of scanning for a free one with find_channel
+        self.channel_ring = [pygame.mixer.Channel(i) for i in range(128)]
+        self.ring_index = 0
+        self.active_notes = [None] * 128
+        self.clear_bank()
+
+    def clear_bank(self):
+        # Processed notes belong to one sample at one mixer rate; anything else would play at the wrong pitch
+        self.processed_sounds = [None] * 128
+        self.sound_pool.clear()
+
+    def clear_resample_cache(self):
+        # Cached notes are views into the bank they were encoded into, so the bank is released with them
+        self.resample_cache.clear()
+        self.bank = None
+        self.bank_rows = {}
+
+    def next_channel(self):
+        ring = self.channel_ring
+        channel = ring[self.ring_index]
+        self.ring_index = (self.ring_index + 1) % len(ring)
+        return channel
+
     def test_sound(self):
         note = 60  # Middle C
-        if note in self.processed_sounds:
-            sound = self.processed_sounds[note]
-            sound.play()
+        sound = self.get_sound(note)
+        if sound is not None:
+            # Through a ring channel like play_note; Sound.play would pick a channel at full volume.
+            # The Sound is shared with MIDI note 60, so its velocity is left alone and only the channel is set
+            channel = self.next_channel()
+            channel.set_volume(self.master_volume)
+            channel.play(sound)
             self.debug_label.setText(f"Playing test sound for note {note}")
         else:
             self.debug_label.setText(f"No processed sound for note {note}")
@@ -165,17 +370,25 @@ class WavInstrumentApp(QtWidgets.QMainWindow):
         )
         if file_name:
             try:
+                with open(file_name, 'rb') as f:
+                    sample_hash = hashlib.sha256(f.read()).hexdigest()[:16]
                 sample_rate, audio_data = wavfile.read(file_name)
-                if len(audio_data.shape) > 1:
-                    audio_data = np.mean(audio_data, axis=1)
+                if audio_data.ndim > 1:
+                    audio_data = downmix(audio_data)
 
-                audio_data = audio_data.astype(np.float32)
-                audio_data /= np.max(np.abs(audio_data))
+                peak = peak_abs(audio_data)
+                audio_data = np.ascontiguousarray(audio_data, dtype=np.float32)
+                if peak:
+                    audio_data /= np.float32(peak)
 
+                self.init_mixer(sample_rate)
+                self.clear_bank()
+                self.clear_resample_cache()
                 self.base_sample = {
                     'path': file_name,
                     'rate': sample_rate,
-                    'data': audio_data
+                    'data': audio_data,
+                    'hash': sample_hash
                 }
                 
                 self.sample_debug.setText(f"Loaded sample: {os.path.basename(file_name)}\n"
@@ -190,89 +403,220 @@ class WavInstrumentApp(QtWidgets.QMainWindow):
             return
 
         try:
-            self.processed_sounds.clear()
-            base_freq = 440 * (2 ** ((self.base_note.value() - 69) / 12))
-            total_notes = self.max_note.value() - self.min_note.value() + 1
-            self.progress.setMaximum(total_notes)
+            self.clear_bank()
+            self.pending_notes.clear()
+            self.bank_cache_path = None
+            data = self.base_sample['data']
+            base_note = self.base_note.value()
+            notes = range(self.min_note.value(), self.max_note.value() + 1)
+            self.progress.setMaximum(len(notes))
             self.progress.setValue(0)
+            if not notes:
+                self.finish_processing()
+                return
+
+            self.bank_cache_path = bank_cache_path(self.base_sample['hash'], notes.start, notes.stop - 1, base_note)
+            if self.load_bank_cache(notes):
+                return
+
+            # Other note layouts need other ratios, so their cached notes would only pin an old bank
+            layout = (notes.start, notes.stop, base_note)
+            if layout != self.cache_layout:
+                self.clear_resample_cache()
+                self.cache_layout = layout
+
+            for note in notes:
+                self.pending_notes[note] = (*resample_factors(note, base_note), id(data))
+            missing = {note: key for note, key in self.pending_notes.items() if key not in self.resample_cache}
+
+            if missing:
+                # One int16 buffer, sized for the longest (lowest) note, is reused for every conversion
+                longest = max(-(-len(data) * up // down) for up, down, _ in missing.values())
+                if len(self.pcm_scratch) < longest:
+                    self.pcm_scratch = np.empty(longest, dtype=np.int16)
+                    self.clip_scratch = np.empty(longest, dtype=np.float32)
+                # Encoded notes are written straight into their row of a bank that only holds the missing notes
+                self.bank = allocate_bank(len(missing), longest)
+                self.bank_rows = {note: row for row, note in enumerate(missing)}
+
+            self.process_button.setEnabled(False)
+            self.load_button.setEnabled(False)
+            pool = QtCore.QThreadPool.globalInstance()
+            for note, key in list(self.pending_notes.items()):
+                if note in missing:
+                    pool.start(ResampleTask(data, key[0], key[1], note, self.resample_signals))
+                else:
+                    self.note_done(note, self.resample_cache[key])
+        except Exception as e:
+            self.pending_notes.clear()
+            self.process_button.setEnabled(True)
+            self.load_button.setEnabled(True)
+            self.sample_debug.setText(f"Error processing sample: {str(e)}")
 
-            for note in range(self.min_note.value(), self.max_note.value() + 1):
-                target_freq = 440 * (2 ** ((note - 69) / 12))
-                pitch_ratio = target_freq / base_freq
-                
-                original_length = len(self.base_sample['data'])
-                new_length = int(original_length / pitch_ratio)
-                
-                resampled = signal.resample(self.base_sample['data'], new_length)
-                audio_int16 = np.int16(resampled * 32767)
-                
-                try:
-                    sound = pygame.mixer.Sound(audio_int16)
-                    self.processed_sounds[note] = sound
-                except Exception as e:
-                    self.sample_debug.setText(f"Error creating sound for note {note}: {str(e)}")
-                    continue
+    def note_resampled(self, note, resampled):
+        if note not in self.pending_notes:
+            return
 
-                self.progress.setValue(note - self.min_note.value() + 1)
-                QtWidgets.QApplication.processEvents()
+        if isinstance(resampled, Exception):
+            self.sample_debug.setText(f"Error processing note {note}: {str(resampled)}")
+            self.note_done(note, None)
+        else:
+            if len(self.pcm_scratch) < len(resampled):
+                self.pcm_scratch = np.empty(len(resampled), dtype=np.int16)
+                self.clip_scratch = np.empty(len(resampled), dtype=np.float32)
+            # The resampler overshoots a peak-normalised signal; clip so the int16 cast cannot wrap around
+            clipped = np.clip(resampled, -1.0, 1.0, out=self.clip_scratch[:len(resampled)])
+            audio_int16 = self.pcm_scratch[:len(resampled)]
+            np.multiply(clipped, 32767, out=audio_int16, casting='unsafe')
+            row = self.bank[self.bank_rows[note]]
+            length = min(len(audio_int16), len(row))
+            self.note_done(note, ulaw_encode(audio_int16[:length], out=row[:length]))
+
+    def note_done(self, note, encoded):
+        key = self.pending_notes.pop(note, None)
+        if key is None:
+            return
 
-            self.sample_debug.setText(f"Processed {len(self.processed_sounds)} notes\n"
-                                      f"Range: {self.min_note.value()} to {self.max_note.value()}")
-        except Exception as e:
-            self.sample_debug.setText(f"Error processing sample: {str(e)}")
+        if encoded is not None:
+            self.resample_cache[key] = encoded
+            self.processed_sounds[note] = encoded
+
+        self.progress.setValue(self.progress.value() + 1)
+        if not self.pending_notes:
+            self.finish_processing()
+
+    def load_bank_cache(self, notes):
+        if not os.path.exists(self.bank_cache_path):
+            return False
+        try:
+            with np.load(self.bank_cache_path) as bank:
+                encoded = [(note, bank[str(note)]) for note in notes]
+        except Exception:
+            return False
+
+        for note, note_encoded in encoded:
+            self.processed_sounds[note] = note_encoded
+        try:
+            # Mark the bank as recently used so pruning removes older ones first
+            os.utime(self.bank_cache_path)
+        except OSError:
+            pass
+        self.bank_cache_path = None
+        self.progress.setValue(len(notes))
+        self.finish_processing()
+        return True
+
+    def finish_processing(self):
+        self.process_button.setEnabled(True)
+        self.load_button.setEnabled(True)
+        processed = [(note, encoded) for note, encoded in enumerate(self.processed_sounds) if encoded is not None]
+        status = (f"Processed {len(processed)} notes\n"
+                  f"Range: {self.min_note.value()} to {self.max_note.value()}")
+
+        # Only complete banks are written, so a cache hit never has missing notes
+        if self.bank_cache_path and len(processed) == self.progress.maximum():
+            try:
+                np.savez(self.bank_cache_path, **{str(note): encoded for note, encoded in processed})
+                prune_bank_cache()
+            except OSError as e:
+                status += f"\nCould not cache processed notes: {str(e)}"
+        self.bank_cache_path = None
+        self.sample_debug.setText(status)
+
+    def get_sound(self, note):
+        sound_pool = self.sound_pool
+        sound = sound_pool.get(note)
+        if sound is not None:
+            sound_pool.move_to_end(note)
+            return sound
+
+        encoded = self.processed_sounds[note]
+        if encoded is None:
+            return None
+        sound = pygame.sndarray.make_sound(ULAW_DECODE[encoded])
+        sound_pool[note] = sound
+        if len(sound_pool) > SOUND_POOL_SIZE:
+            sound_pool.popitem(last=False)
+        return sound
 
     def update_volume(self):
-        master_volume = self.volume_slider.value() / 100.0
-        for sound in self.processed_sounds.values():
-            sound.set_volume(master_volume)
+        # Master volume lives on the channel, so only notes that are sounding need updating
+        self.master_volume = self.volume_slider.value() / 100.0
+        for active in self.active_notes:
+            if active is not None:
+                active[0].set_volume(self.master_volume)
+
+    def set_debug_enabled(self, enabled):
+        self.debug_enabled = enabled
+
+    def flush_debug(self):
+        text = self.pending_debug
+        if text is not self.shown_debug:
+            self.shown_debug = text
+            self.note_debug.setText(text)
 
     def midi_callback(self, message, time_stamp=None):
-        if not message or len(message[0]) < 3:
+        if not message:
             return
+        # rtmidi passes (data bytes, delta time); index the data list once and work on locals
+        data = message[0]
+        if len(data) < 3:
+            return
+        status, note, velocity = data[0], data[1], data[2]
 
-        status = message[0][0]
-        note = message[0][1]
-        velocity = message[0][2]
-        channel = status & 0x0F  # Extract channel number
+        if self.debug_enabled:
+            channel = status & 0x0F  # Extract channel number
+            self.pending_debug = f"MIDI event: status={hex(status)}, channel={channel}, note={note}, velocity={velocity}"
 
-        self.note_debug.setText(f"MIDI event: status={hex(status)}, channel={channel}, note={note}, velocity={velocity}")
+        handler = self.midi_dispatch[status]
+        if handler:
+            handler(note, velocity)
 
-        # Note On (0x90 to 0x9F) or Note On for channel 9 (0x98)
-        if (0x90 <= status <= 0x9F or status == 0x98) and velocity > 0:
+    def note_on(self, note, velocity):
+        # Note On with velocity = 0 is a Note Off
+        if velocity:
             self.play_note(note, velocity)
-        # Note Off (0x80 to 0x8F) or Note On with velocity = 0 (0x90 with velocity = 0)
-        elif (0x80 <= status <= 0x8F or (status == 0x98 and velocity == 0)):
+        else:
             self.stop_note(note)
 
+    def note_off(self, note, velocity):
+        self.stop_note(note)
+
     def play_note(self, note, velocity):
-        if note in self.processed_sounds:
+        if self.processed_sounds[note] is not None:
             try:
-                volume = (velocity / 127) * (self.volume_slider.value() / 100)
-                channel = pygame.mixer.find_channel()
-                if channel:
-                    sound = self.processed_sounds[note]
-                    sound.set_volume(volume)
-                    channel.play(sound)
-                    self.active_notes[note] = channel
-                    self.note_debug.setText(f"Playing note: {note} (velocity: {velocity})")
-                else:
-                    self.note_debug.setText("No free channels available")
+                channel = self.next_channel()
+                sound = self.get_sound(note)
+                sound.set_volume(velocity / 127)
+                channel.set_volume(self.master_volume)
+                channel.play(sound)
+                self.active_notes[note] = (channel, sound)
+                if self.debug_enabled:
+                    self.pending_debug = f"Playing note: {note} (velocity: {velocity})"
             except Exception as e:
-                self.note_debug.setText(f"Error playing note {note}: {str(e)}")
-        else:
-            self.note_debug.setText(f"No sound processed for note {note}")
+                self.pending_debug = f"Error playing note {note}: {str(e)}"
+        elif self.debug_enabled:
+            self.pending_debug = f"No sound processed for note {note}"
 
     def stop_note(self, note):
-        if note in self.active_notes:
+        active_notes = self.active_notes
+        active = active_notes[note]
+        if active is not None:
+            active_notes[note] = None
+            channel, sound = active
             try:
-                channel = self.active_notes[note]
-                channel.stop()
-                del self.active_notes[note]
-                self.note_debug.setText(f"Stopped note: {note}")
+                # The ring may have handed this channel to a newer note since; leave that one playing
+                if channel.get_sound() is sound:
+                    channel.stop()
+                if self.debug_enabled:
+                    self.pending_debug = f"Stopped note: {note}"
             except Exception as e:
-                self.note_debug.setText(f"Error stopping note {note}: {str(e)}")
+                self.pending_debug = f"Error stopping note {note}: {str(e)}"
 
     def closeEvent(self, event):
+        pool = QtCore.QThreadPool.globalInstance()
+        pool.clear()
+        pool.waitForDone()
         if self.midi_in:
             self.midi_in.close_port()
         pygame.mixer.quit()